@@ -1,20 +1,35 @@
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, Response
 from flask_cors import CORS
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from http.cookiejar import DefaultCookiePolicy
 import time
+import math
 import os
-from datetime import datetime
-from collections import defaultdict, deque
+import threading
 import logging
+import logging.handlers
+import queue
+import atexit
+
+# Simple logging setup: request threads only enqueue records, a single
+# listener thread does the actual file/console writes
+log_queue = queue.Queue(-1)
+log_formatter = logging.Formatter('%(asctime)s - %(message)s')
+file_handler = logging.FileHandler('requests.log')
+file_handler.setFormatter(log_formatter)
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(log_formatter)
+log_listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler)
+log_listener.start()
+atexit.register(log_listener.stop)  # Flush pending records on shutdown
 
-# Simple logging setup
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(message)s',
-    handlers=[
-        logging.FileHandler('requests.log'),
-        logging.StreamHandler()
-    ]
+    format='%(message)s',  # Timestamps are added by the listener's formatter
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
 logger = logging.getLogger(__name__)
 
@@ -23,73 +38,174 @@ CORS(app, origins=["*"])
 
 # Simple Configuration
 BACKEND_URL = os.getenv('BACKEND_URL')
+BACKEND_BASE_URL = BACKEND_URL.rstrip('/')
 REQUESTS_PER_HOUR = int(os.getenv('REQUESTS_PER_HOUR'))
 DDOS_REQUESTS_PER_MINUTE = int(os.getenv('DDOS_REQUESTS_PER_MINUTE'))
 BLOCK_DURATION_MINUTES = int(os.getenv('BLOCK_DURATION_MINUTES'))
+CLEANUP_INTERVAL_SECONDS = 60
+VERBOSE = os.getenv('VERBOSE_LOG') == '1'  # Also log successful requests
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
-# Data storage
-ip_requests = defaultdict(deque)  # IP -> list of request times
+# Data storage (sharded so worker threads don't contend on one dict)
+SHARDS = 16  # Must be a power of two
+HOUR_REFILL_RATE = REQUESTS_PER_HOUR / 3600  # Tokens per second
+MINUTE_REFILL_RATE = DDOS_REQUESTS_PER_MINUTE / 60
+ip_shards = [{} for _ in range(SHARDS)]  # IP -> IpState
+shard_locks = [threading.Lock() for _ in range(SHARDS)]
 blocked_ips = {}  # IP -> unblock_time
-stats = defaultdict(int)  # Simple statistics
+blocked_lock = threading.Lock()
+# One bit per hash(ip) & 0xFFFF, set if that IP may be blocked. Bits are only
+# cleared when cleanup rebuilds the hint, so a clear bit means "not blocked"
+blocked_hint = bytearray(8192)
+# Simple statistics (every status is preallocated so updates never insert keys)
+stats = dict.fromkeys((
+    'SUCCESS', 'BLOCKED', 'RATE_LIMITED', 'DDOS_BLOCKED', 'TIMEOUT',
+    'CONNECTION_ERROR', 'ERROR', 'NOT_FOUND', 'SERVER_ERROR', 'total'
+), 0)
+stats_lock = threading.Lock()
+
+# Headers that must not be copied between client and backend
+REQUEST_EXCLUDED_HEADERS = frozenset({'host', 'content-length'})
+RESPONSE_EXCLUDED_HEADERS = frozenset({'content-encoding', 'content-length', 'transfer-encoding', 'connection'})
+
+# Shared backend session so keep-alive connections are reused across requests
+backend_adapter = HTTPAdapter(pool_connections=64, pool_maxsize=256, max_retries=0)
+backend_session = requests.Session()
+backend_session.mount('http://', backend_adapter)
+backend_session.mount('https://', backend_adapter)
+backend_session.trust_env = False
+# Never carry backend cookies from one client over to another
+backend_session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+def json_response(data, status=200):
+    """Build a JSON response (orjson is much faster than jsonify)"""
+    return Response(orjson.dumps(data), status=status, mimetype='application/json')
+
+def get_shard(ip):
+    """Get the shard index for an IP"""
+    return hash(ip) & (SHARDS - 1)
+
+class IpState:
+    """Token buckets for one IP"""
+    __slots__ = ('hour', 'minute', 'last')
+    
+    def __init__(self, now):
+        self.hour = REQUESTS_PER_HOUR  # Hourly tokens left
+        self.minute = DDOS_REQUESTS_PER_MINUTE  # Per-minute tokens left
+        self.last = now  # Last refill (monotonic)
+
+def hour_tokens_at(state, now):
+    """Get an IP's hourly tokens refilled up to `now` (monotonic)"""
+    return min(REQUESTS_PER_HOUR, state.hour + (now - state.last) * HOUR_REFILL_RATE)
+
+def get_hint_bit(ip):
+    """Get the blocked_hint byte index and bit mask for an IP"""
+    h = hash(ip) & 0xFFFF
+    return h >> 3, 1 << (h & 7)
 
 def get_real_ip():
     """Get the real client IP address"""
-    # Check common proxy headers
-    forwarded = request.headers.get('X-Forwarded-For')
+    # Check common proxy headers (straight from the WSGI environ dict)
+    environ = request.environ
+    forwarded = environ.get('HTTP_X_FORWARDED_FOR')
     if forwarded:
-        return forwarded.split(',')[0].strip()
+        return forwarded.partition(',')[0].strip()
     
-    real_ip = request.headers.get('X-Real-IP')
-    if real_ip:
-        return real_ip
-    
-    return request.remote_addr or 'unknown'
+    return environ.get('HTTP_X_REAL_IP') or environ.get('REMOTE_ADDR') or 'unknown'
 
 def cleanup_old_data():
     """Remove old request data"""
     current_time = time.time()
-    one_hour_ago = current_time - 3600
-    one_minute_ago = current_time - 60
+    # Buckets idle for an hour are full again and can be forgotten
+    one_hour_ago = time.monotonic() - 3600
     
-    # Clean hourly request data
-    for ip in list(ip_requests.keys()):
-        while ip_requests[ip] and ip_requests[ip][0] < one_hour_ago:
-            ip_requests[ip].popleft()
-        if not ip_requests[ip]:
-            del ip_requests[ip]
+    # Clean idle IPs, one shard at a time
+    for shard, lock in zip(ip_shards, shard_locks):
+        with lock:
+            for ip in list(shard.keys()):
+                if shard[ip].last < one_hour_ago:
+                    del shard[ip]
     
     # Remove expired blocks
-    for ip in list(blocked_ips.keys()):
-        if blocked_ips[ip] < current_time:
-            del blocked_ips[ip]
-            logger.info(f"✅ Unblocked IP: {ip}")
+    global blocked_hint
+    with blocked_lock:
+        for ip in list(blocked_ips.keys()):
+            if blocked_ips[ip] < current_time:
+                del blocked_ips[ip]
+                logger.info(f"✅ Unblocked IP: {ip}")
+        
+        # Rebuild the hint so bits of unblocked IPs are cleared
+        hint = bytearray(8192)
+        for ip in blocked_ips:
+            index, bit = get_hint_bit(ip)
+            hint[index] |= bit
+        blocked_hint = hint
+
+def cleanup_worker():
+    """Periodically reclaim memory from idle IPs and expired blocks"""
+    while True:
+        time.sleep(CLEANUP_INTERVAL_SECONDS)
+        try:
+            cleanup_old_data()
+        except Exception as e:
+            logger.error(f"Cleanup failed: {str(e)}")
+
+# Cleanup runs off the request path
+threading.Thread(target=cleanup_worker, name='cleanup', daemon=True).start()
 
 def is_ip_blocked(ip):
     """Check if IP is currently blocked"""
-    return ip in blocked_ips and blocked_ips[ip] > time.time()
+    # Fast path: most IPs were never blocked and skip the dict lookup
+    index, bit = get_hint_bit(ip)
+    if not blocked_hint[index] & bit:
+        return False
+    
+    unblock_time = blocked_ips.get(ip)
+    return unblock_time is not None and unblock_time > time.time()
 
 def check_rate_limit(ip):
     """Check if IP exceeded rate limit"""
     current_time = time.time()
+    now = time.monotonic()
+    s = get_shard(ip)
     
-    # Add current request
-    ip_requests[ip].append(current_time)
-    
-    # Count requests in last hour
-    hour_count = len(ip_requests[ip])
+    with shard_locks[s]:
+        state = ip_shards[s].get(ip)
+        if state is None:
+            state = IpState(now)
+            ip_shards[s][ip] = state
+        
+        # Refill both buckets for the time since the last request
+        hour_tokens = hour_tokens_at(state, now)
+        minute_tokens = min(DDOS_REQUESTS_PER_MINUTE,
+                            state.minute + (now - state.last) * MINUTE_REFILL_RATE)
+        
+        # Every request counts towards DDoS detection
+        minute_tokens -= 1
+        ddos = minute_tokens < 1
+        
+        # Only allowed requests use up the hourly quota
+        rate_limited = hour_tokens < 1
+        if not ddos and not rate_limited:
+            hour_tokens -= 1
+        
+        state.hour, state.minute, state.last = hour_tokens, minute_tokens, now
     
-    # Count requests in last minute (for DDoS detection)
-    minute_requests = sum(1 for t in ip_requests[ip] if t > current_time - 60)
+    # Requests used in the current hour (including this one)
+    hour_count = math.ceil(REQUESTS_PER_HOUR - hour_tokens)
     
     # Check DDoS (too many requests per minute)
-    if minute_requests >= DDOS_REQUESTS_PER_MINUTE:
+    if ddos:
         block_until = current_time + (BLOCK_DURATION_MINUTES * 60)
-        blocked_ips[ip] = block_until
-        logger.warning(f"🚨 BLOCKED IP {ip}: {minute_requests} requests/minute (DDoS)")
+        index, bit = get_hint_bit(ip)
+        with blocked_lock:
+            blocked_ips[ip] = block_until
+            blocked_hint[index] |= bit
+        logger.warning(f"🚨 BLOCKED IP {ip}: {DDOS_REQUESTS_PER_MINUTE}+ requests/minute (DDoS)")
         return False, hour_count, "DDoS detected"
     
     # Check hourly rate limit
-    if hour_count > REQUESTS_PER_HOUR:
+    if rate_limited:
         logger.warning(f"⚠️ RATE LIMITED IP {ip}: {hour_count}/{REQUESTS_PER_HOUR} requests/hour")
         return False, hour_count, "Rate limit exceeded"
     
@@ -97,19 +213,23 @@ def check_rate_limit(ip):
 
 def log_request(ip, method, path, status, details=""):
     """Log request details"""
-    stats[status] += 1
-    stats['total'] += 1
+    with stats_lock:
+        stats[status] += 1
+        stats['total'] += 1
     
-    log_msg = f"IP:{ip} | {method} {path} | {status}"
-    if details:
-        log_msg += f" | {details}"
+    # Successful requests are the bulk of traffic; only log them when verbose
+    if status == "SUCCESS" and not VERBOSE:
+        return
     
-    logger.info(log_msg)
+    # Let logging format the message only if the record will be emitted
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("IP:%s | %s %s | %s%s", ip, method, path, status,
+                    f" | {details}" if details else "")
 
 @app.route('/')
 def home():
     """Service information"""
-    return jsonify({
+    return json_response({
         'service': 'API Rate Limiter',
         'status': 'running',
         # 'backend_url': BACKEND_URL,
@@ -128,49 +248,58 @@ def home():
 @app.route('/health')
 def health():
     """Health check with basic stats"""
-    cleanup_old_data()
-    
-    return jsonify({
+    return json_response({
         'status': 'healthy',
         # 'backend_url': BACKEND_URL,
-        'active_ips': len(ip_requests),
+        'active_ips': sum(len(shard) for shard in ip_shards),
         'blocked_ips': len(blocked_ips),
         'total_requests': stats.get('total', 0),
         'successful_requests': stats.get('SUCCESS', 0),
         'blocked_requests': stats.get('BLOCKED', 0),
         'rate_limited_requests': stats.get('RATE_LIMITED', 0),
-        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        'timestamp': time.strftime(TIME_FORMAT)
     })
 
 @app.route('/stats')
 def get_stats():
     """Detailed statistics"""
-    cleanup_old_data()
     current_time = time.time()
+    now = time.monotonic()
     
     # Current blocked IPs
     blocked_list = []
-    for ip, unblock_time in blocked_ips.items():
+    with blocked_lock:
+        blocked_snapshot = list(blocked_ips.items())
+    for ip, unblock_time in blocked_snapshot:
         remaining_minutes = max(0, int((unblock_time - current_time) / 60))
         blocked_list.append({
             'ip': ip,
             'remaining_minutes': remaining_minutes,
-            'unblock_time': datetime.fromtimestamp(unblock_time).strftime('%Y-%m-%d %H:%M:%S')
+            'unblock_time': time.strftime(TIME_FORMAT, time.localtime(unblock_time))
         })
     
-    # Current IP usage
+    # Current IP usage (only copy tokens under the lock, compute outside it)
+    hour_tokens = []
+    for shard, lock in zip(ip_shards, shard_locks):
+        with lock:
+            hour_tokens.extend([(ip, hour_tokens_at(state, now)) for ip, state in shard.items()])
+    
     ip_usage = {}
-    for ip, requests in ip_requests.items():
+    for ip, tokens in hour_tokens:
+        remaining = int(tokens)
         ip_usage[ip] = {
-            'requests_this_hour': len(requests),
-            'remaining_requests': max(0, REQUESTS_PER_HOUR - len(requests))
+            'requests_this_hour': REQUESTS_PER_HOUR - remaining,
+            'remaining_requests': remaining
         }
     
-    return jsonify({
-        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+    with stats_lock:
+        stats_snapshot = dict(stats)
+    
+    return json_response({
+        'timestamp': time.strftime(TIME_FORMAT),
         'blocked_ips': blocked_list,
         'ip_usage': ip_usage,
-        'statistics': dict(stats),
+        'statistics': stats_snapshot,
         'configuration': {
             # 'backend_url': BACKEND_URL,
             'requests_per_hour': REQUESTS_PER_HOUR,
@@ -182,12 +311,13 @@ def get_stats():
 @app.route('/unblock/<ip>')
 def unblock_ip(ip):
     """Manually unblock an IP"""
-    if ip in blocked_ips:
-        del blocked_ips[ip]
+    with blocked_lock:
+        was_blocked = blocked_ips.pop(ip, None) is not None
+    if was_blocked:
         logger.info(f"🔓 MANUALLY UNBLOCKED: {ip}")
-        return jsonify({'message': f'IP {ip} has been unblocked', 'success': True})
+        return json_response({'message': f'IP {ip} has been unblocked', 'success': True})
     else:
-        return jsonify({'message': f'IP {ip} was not blocked', 'success': False})
+        return json_response({'message': f'IP {ip} was not blocked', 'success': False})
 
 # Main proxy route - handles all requests
 @app.route('/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS'])
@@ -197,112 +327,118 @@ def proxy_request(path=""):
     method = request.method
     url_path = f"/{path}"
     
-    # Clean old data periodically
-    cleanup_old_data()
-    
     # Check if IP is blocked
     if is_ip_blocked(ip):
-        remaining_time = int((blocked_ips[ip] - time.time()) / 60)
+        unblock_time = blocked_ips.get(ip, time.time())
+        remaining_time = int((unblock_time - time.time()) / 60)
         log_request(ip, method, url_path, "BLOCKED", f"{remaining_time} minutes remaining")
-        return jsonify({
+        return json_response({
             'error': 'IP temporarily blocked',
             'reason': 'Too many requests detected',
             'remaining_minutes': remaining_time,
-            'unblock_time': datetime.fromtimestamp(blocked_ips[ip]).strftime('%Y-%m-%d %H:%M:%S')
-        }), 429
+            'unblock_time': time.strftime(TIME_FORMAT, time.localtime(unblock_time))
+        }, 429)
     
     # Check rate limits
     allowed, request_count, reason = check_rate_limit(ip)
     if not allowed:
         if "DDoS" in reason:
             log_request(ip, method, url_path, "DDOS_BLOCKED", reason)
-            return jsonify({
+            return json_response({
                 'error': 'IP blocked due to suspicious activity',
                 'reason': reason,
                 'block_duration_minutes': BLOCK_DURATION_MINUTES
-            }), 429
+            }, 429)
         else:
             log_request(ip, method, url_path, "RATE_LIMITED", f"{request_count}/{REQUESTS_PER_HOUR}")
-            return jsonify({
+            return json_response({
                 'error': 'Rate limit exceeded',
                 'limit': f"{REQUESTS_PER_HOUR} requests per hour",
                 'current_count': request_count,
                 'reset_in_minutes': 60
-            }), 429
+            }, 429)
     
     # Forward request to backend
     try:
-        backend_url = f"{BACKEND_URL.rstrip('/')}/{path}"
+        backend_url = f"{BACKEND_BASE_URL}/{path}"
         
         # Copy headers (remove problematic ones)
         headers = {k: v for k, v in request.headers.items() 
-                  if k.lower() not in ['host', 'content-length']}
+                  if k.lower() not in REQUEST_EXCLUDED_HEADERS}
         
         # Handle different request types
         if method == 'GET':
-            response = requests.get(backend_url, params=request.args, headers=headers, timeout=30)
+            response = backend_session.get(backend_url, params=request.args, headers=headers,
+                                           stream=True, timeout=30)
         
         elif method == 'POST':
             if request.content_type and 'multipart/form-data' in request.content_type:
-                # File uploads
-                files = {name: (file.filename, file.stream, file.content_type) 
-                        for name, file in request.files.items()}
-                data = request.form.to_dict()
-                response = requests.post(backend_url, data=data, files=files, 
-                                       headers={k: v for k, v in headers.items() 
-                                              if k.lower() != 'content-type'}, timeout=30)
+                # File uploads (encoder streams each file instead of building the body in memory)
+                fields = list(request.form.items(multi=True))
+                fields.extend((name, (file.filename, file.stream, file.content_type))
+                              for name, file in request.files.items(multi=True))
+                encoder = MultipartEncoder(fields=fields)
+                upload_headers = {k: v for k, v in headers.items() 
+                                  if k.lower() != 'content-type'}
+                upload_headers['Content-Type'] = encoder.content_type
+                response = backend_session.post(backend_url, data=encoder, headers=upload_headers,
+                                                stream=True, timeout=30)
             elif request.is_json:
                 # JSON data
-                response = requests.post(backend_url, json=request.get_json(), 
-                                       headers=headers, timeout=30)
+                response = backend_session.post(backend_url, json=request.get_json(), 
+                                                headers=headers, stream=True, timeout=30)
             else:
                 # Raw data
-                response = requests.post(backend_url, data=request.get_data(), 
-                                       headers=headers, timeout=30)
+                response = backend_session.post(backend_url, data=request.get_data(), 
+                                                headers=headers, stream=True, timeout=30)
         
         else:
             # Other methods (PUT, DELETE, etc.)
-            response = requests.request(method, backend_url, headers=headers, 
-                                      data=request.get_data(), params=request.args, timeout=30)
+            response = backend_session.request(method, backend_url, headers=headers, 
+                                               data=request.get_data(), params=request.args,
+                                               stream=True, timeout=30)
         
-        # Log success
-        log_request(ip, method, url_path, "SUCCESS", 
-                   f"→ Backend {response.status_code} | {request_count}/{REQUESTS_PER_HOUR}")
+        # Log success (details are only built when successful requests are logged)
+        details = f"→ Backend {response.status_code} | {request_count}/{REQUESTS_PER_HOUR}" if VERBOSE else ""
+        log_request(ip, method, url_path, "SUCCESS", details)
         
         # Return response
-        excluded_headers = ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
         response_headers = {k: v for k, v in response.headers.items() 
-                          if k.lower() not in excluded_headers}
+                          if k.lower() not in RESPONSE_EXCLUDED_HEADERS}
         
-        return Response(
-            response.content,
+        # Stream the body through instead of buffering it all in memory
+        proxy_response = Response(
+            response.iter_content(chunk_size=65536),
             status=response.status_code,
             headers=response_headers
         )
+        # Release the backend connection even if the body is never sent (HEAD, 204, 304)
+        proxy_response.call_on_close(response.close)
+        return proxy_response
     
     except requests.exceptions.Timeout:
         log_request(ip, method, url_path, "TIMEOUT", "Backend timeout")
-        return jsonify({'error': 'Backend service timeout'}), 504
+        return json_response({'error': 'Backend service timeout'}, 504)
     
     except requests.exceptions.ConnectionError:
         log_request(ip, method, url_path, "CONNECTION_ERROR", "Backend unavailable")
-        return jsonify({'error': 'Backend service unavailable'}), 502
+        return json_response({'error': 'Backend service unavailable'}, 502)
     
     except Exception as e:
         log_request(ip, method, url_path, "ERROR", f"Proxy error: {str(e)}")
-        return jsonify({'error': 'Proxy server error', 'details': str(e)}), 500
+        return json_response({'error': 'Proxy server error', 'details': str(e)}, 500)
 
 @app.errorhandler(404)
 def not_found(e):
     ip = get_real_ip()
     log_request(ip, request.method, request.path, "NOT_FOUND", "")
-    return jsonify({'error': 'Endpoint not found'}), 404
+    return json_response({'error': 'Endpoint not found'}, 404)
 
 @app.errorhandler(500)
 def server_error(e):
     ip = get_real_ip()
     log_request(ip, request.method, request.path, "SERVER_ERROR", str(e))
-    return jsonify({'error': 'Internal server error'}), 500
+    return json_response({'error': 'Internal server error'}, 500)
 
 if __name__ == '__main__':
     print("\n" + "="*50)